@@ -4,10 +4,14 @@ from optimizers import *
 from nerdata import *
 from utils import *
 from tqdm import tqdm
-from collections import Counter
-from typing import List
+from numba import njit
+from joblib import Parallel, delayed
+from collections import defaultdict
+from typing import Dict, List
 
 import numpy as np
+from scipy import sparse
+import threading
 import time
 import os
 
@@ -42,6 +46,18 @@ class ProbabilisticSequenceScorer(object):
         word_idx = self.word_indexer.index_of(word) if self.word_indexer.contains(word) else self.word_indexer.index_of("UNK")
         return self.emission_log_probs[tag_idx, word_idx]
 
+def get_word_ids(word_indexer: Indexer, sentence_tokens: List[Token]) -> np.ndarray:
+    """
+    Looks up the emission matrix column of every token in the sentence, mapping unseen words to UNK. Doing this once per
+    sentence keeps the dictionary lookups out of the decoding recursion.
+    :param word_indexer: Indexer mapping words to indices in the emission probabilities matrix
+    :param sentence_tokens: List of the tokens in the sentence
+    :return: [num_words] int32 array of word indices
+    """
+    unk_idx = word_indexer.index_of("UNK")
+    return np.fromiter((word_indexer.index_of(tok.word) if word_indexer.contains(tok.word) else unk_idx for tok in sentence_tokens), dtype=np.int32, count=len(sentence_tokens))
+
+
 class HmmNerModel(object):
     """
     HMM NER model for predicting tags
@@ -60,38 +76,26 @@ class HmmNerModel(object):
         self.transition_log_probs = transition_log_probs
         self.emission_log_probs = emission_log_probs
 
-    def decode(self, sentence_tokens: List[Token])->LabeledSentence:
+    def decode(self, sentence_tokens: List[Token], beam: int = None, threshold: float = None)->LabeledSentence:
         """
         See BadNerModel for an example implementation
         :param sentence_tokens: List of the tokens in the sentence to tag
+        :param beam: if set, only the top beam states are kept at each position (approximate decoding)
+        :param threshold: if set, states scoring worse than the best by more than a factor of threshold are pruned
         :return: The LabeledSentence consisting of predictions over the sentence
         """
-        scorer=ProbabilisticSequenceScorer(self.tag_indexer,self.word_indexer,self.init_log_probs,self.transition_log_probs,self.emission_log_probs)
-        pred_tags=[]
         T=len(sentence_tokens)
         N=len(self.tag_indexer)
-        viterbi=np.zeros(shape=(N,T))
-        backpointer=np.zeros(shape=(N,T))
+        # Emission scores depend only on the word, so gather them for the whole sentence once: [num_tags, num_words]
+        emis_cols = self.emission_log_probs[:, get_word_ids(self.word_indexer, sentence_tokens)]
+        viterbi, backpointer = _decode_scratch.get(N, T, emis_cols.dtype)
         #referenced from https://stanford.edu/~jurafsky/slp3/A.pdf
-        #Initialization
-        for s in range(N):
-            viterbi[s, 0] = scorer.score_init(sentence_tokens, s) + scorer.score_emission(sentence_tokens, s, 0)
-            backpointer[s,0]=0
-        # Recursion
-        for t in range(1, T):
-            for s in range(N):
-                vite = np.zeros(N)
-                bpt = np.zeros(N)
-                for sft in range(N):
-                    vite[sft] = viterbi[sft, t - 1] + scorer.score_transition(sentence_tokens, sft,s) + scorer.score_emission(sentence_tokens,s,t)
-                    bpt[sft] = viterbi[sft, t - 1] + scorer.score_transition(sentence_tokens, sft,s)
-                viterbi[s, t] = np.max(vite)
-                backpointer[s, t] = np.argmax(bpt)
+        if beam is None and threshold is None:
+            viterbi, backpointer, best_last = _viterbi_decode(self.init_log_probs, self.transition_log_probs, emis_cols, viterbi, backpointer)
+        else:
+            viterbi, backpointer, best_last = _beam_decode(self.init_log_probs, self.transition_log_probs, emis_cols, viterbi, backpointer, *_beam_args(N, beam, threshold))
         # Backtrace
-        pred_tags.append(self.tag_indexer.get_object(np.argmax(viterbi[:, T - 1])))
-        for t in range(1, T):
-            pred_tags.append(self.tag_indexer.get_object(backpointer[self.tag_indexer.index_of(pred_tags[-1]), T - t]))
-        pred_tags = list(reversed(pred_tags))
+        pred_tags = [self.tag_indexer.get_object(idx) for idx in _backtrace(backpointer, best_last)]
         return LabeledSentence(sentence_tokens, chunks_from_bio_tag_seq(pred_tags))
 
 
@@ -99,30 +103,211 @@ class HmmNerModel(object):
 def viterbi(sentence_tokens: List[Token], scorer: ProbabilisticSequenceScorer)->LabeledSentence:
     N = len(sentence_tokens)
     T = len(scorer.tag_indexer)
-    v = np.zeros((N, T)) 
-    y_pred = np.zeros((N, T))
-    # Initial states
-    for y in range(T):
-        # prob of having state y,
-        v[0, y] = scorer.score_init(sentence_tokens, y) + scorer.score_emission(sentence_tokens, y, 0)
-
-    for i in range(1, N):
-        for y in range(T):
-            previous_prob = np.zeros(T)
-            for y_prev in range(T):
-                previous_prob[y_prev] = scorer.score_transition(sentence_tokens, y_prev, y) + v[i-1, y_prev]
-            v[i, y] = scorer.score_emission(sentence_tokens, y, i) + np.max(previous_prob)
-            y_pred[i, y] = np.argmax(previous_prob)
-
-    idx = int(np.argmax(v[-1, :]))
-    pred_tags = [(scorer.tag_indexer.get_object(idx))]
-    for t in range(1, N):
-        idx = int(y_pred[N - t, idx])
-        pred_tags.append(scorer.tag_indexer.get_object(idx))
-    pred_tags.reverse()
+    emis_cols = scorer.emission_log_probs[:, get_word_ids(scorer.word_indexer, sentence_tokens)]
+    v, y_pred = _decode_scratch.get(T, N, emis_cols.dtype)
+    v, y_pred, idx = _viterbi_decode(scorer.init_log_probs, scorer.transition_log_probs, emis_cols, v, y_pred)
+    pred_tags = [scorer.tag_indexer.get_object(tag_idx) for tag_idx in _backtrace(y_pred, idx)]
     return LabeledSentence(sentence_tokens, chunks_from_bio_tag_seq(pred_tags))
 
 
+def _backtrace(backpointer: np.ndarray, best_last: int) -> List[int]:
+    """
+    Follows Viterbi backpointers from the best final tag, staying in index space until the caller maps to tag strings.
+    :param backpointer: [num_tags, num_words] backpointers from _viterbi_decode or _beam_decode
+    :param best_last: tag index of the best final state
+    :return: list of tag indices, one per word
+    """
+    tag_idxs = [int(best_last)]
+    for t in range(backpointer.shape[1] - 1, 0, -1):
+        tag_idxs.append(int(backpointer[tag_idxs[-1], t]))
+    tag_idxs.reverse()
+    return tag_idxs
+
+
+class _DecodeScratch(threading.local):
+    """
+    Per-thread score and backpointer buffers that decoders reuse across sentences instead of allocating new ones for every
+    call. Buffers only grow when a longer sentence (or a different tag set or dtype) comes along.
+    """
+    def __init__(self):
+        self.scores = np.empty((0, 512), dtype=np.float32)
+        self.backpointer = np.empty((0, 512), dtype=np.int32)
+
+    def get(self, num_tags: int, num_words: int, dtype):
+        """
+        :return: ([num_tags, num_words] score view, [num_tags, num_words] int32 backpointer view). Contents are garbage
+        and are only valid until the next call on this thread.
+        """
+        if self.scores.shape[0] != num_tags or self.scores.shape[1] < num_words or self.scores.dtype != dtype:
+            capacity = max(num_words, self.scores.shape[1])
+            self.scores = np.empty((num_tags, capacity), dtype=dtype)
+            self.backpointer = np.empty((num_tags, capacity), dtype=np.int32)
+        return self.scores[:, :num_words], self.backpointer[:, :num_words]
+
+
+_decode_scratch = _DecodeScratch()
+
+
+@njit(cache=True, nogil=True)
+def _viterbi_decode(init_scores: np.ndarray, transition_scores: np.ndarray, emission_scores: np.ndarray, viterbi: np.ndarray, backpointer: np.ndarray):
+    """
+    Compiled Viterbi recursion shared by the HMM and CRF decoders. Max and argmax are always computed in the same scan,
+    both over the previous tag and over the final column.
+    :param init_scores: [num_tags] scores for the first tag
+    :param transition_scores: [num_tags, num_tags] scores (prev, curr); -inf marks a forbidden transition
+    :param emission_scores: [num_tags, num_words] emission score of each tag at each position
+    :param viterbi: [num_tags, num_words] output buffer for the Viterbi scores (see _DecodeScratch)
+    :param backpointer: [num_tags, num_words] int32 output buffer for the backpointers
+    :return: (viterbi, backpointer, best final tag index)
+    """
+    num_tags, num_words = emission_scores.shape
+    for y in range(num_tags):
+        viterbi[y, 0] = init_scores[y] + emission_scores[y, 0]
+        backpointer[y, 0] = 0
+    for t in range(1, num_words):
+        for y in range(num_tags):
+            best = -np.inf
+            best_prev = 0
+            for y_prev in range(num_tags):
+                score = viterbi[y_prev, t - 1] + transition_scores[y_prev, y]
+                if score > best:
+                    best = score
+                    best_prev = y_prev
+            viterbi[y, t] = best + emission_scores[y, t]
+            backpointer[y, t] = best_prev
+    best_last = 0
+    for y in range(1, num_tags):
+        if viterbi[y, num_words - 1] > viterbi[best_last, num_words - 1]:
+            best_last = y
+    return viterbi, backpointer, best_last
+
+
+def _beam_args(num_tags: int, beam: int, threshold: float):
+    """
+    Validates decode's beam/threshold arguments and converts them to what _beam_decode takes.
+    :param num_tags: number of tags
+    :param beam: number of states kept per position, or None to not cap it
+    :param threshold: states scoring below best - log(threshold) are dropped (e.g. 1000.0), or None to skip this
+    :return: (beam size, log threshold), with None replaced by num_tags and inf respectively
+    """
+    if beam is not None and beam < 1:
+        raise ValueError("beam must be at least 1, got %s" % beam)
+    if threshold is not None and threshold <= 0:
+        raise ValueError("threshold must be positive, got %s" % threshold)
+    return (num_tags if beam is None else int(beam)), (np.inf if threshold is None else float(np.log(threshold)))
+
+
+@njit(cache=True, nogil=True)
+def _beam_decode(init_scores: np.ndarray, transition_scores: np.ndarray, emission_scores: np.ndarray, scores: np.ndarray, backpointer: np.ndarray, beam_size: int, log_threshold: float):
+    """
+    Beam-pruned version of _viterbi_decode: each position only extends the states that survived pruning at the previous
+    one, so the work per position is O(beam * num_tags) instead of O(num_tags^2). Same arguments and return values as
+    _viterbi_decode; pruned states score -inf.
+    :param beam_size: number of states kept per position (see _beam_args)
+    :param log_threshold: states scoring below best - log_threshold are dropped; inf disables this
+    """
+    num_tags, num_words = emission_scores.shape
+    active = np.empty(num_tags, dtype=np.int64)
+    for y in range(num_tags):
+        scores[y, 0] = init_scores[y] + emission_scores[y, 0]
+        backpointer[y, 0] = 0
+    num_active = _prune_beam(scores[:, 0], beam_size, log_threshold, active)
+    for t in range(1, num_words):
+        # Keep the best surviving predecessor of each tag
+        for y in range(num_tags):
+            best = -np.inf
+            best_prev = active[0]
+            for k in range(num_active):
+                y_prev = active[k]
+                score = scores[y_prev, t - 1] + transition_scores[y_prev, y]
+                if score > best:
+                    best = score
+                    best_prev = y_prev
+            scores[y, t] = best + emission_scores[y, t]
+            backpointer[y, t] = best_prev
+        num_active = _prune_beam(scores[:, t], beam_size, log_threshold, active)
+    return scores, backpointer, active[0]
+
+
+@njit(cache=True, nogil=True)
+def _prune_beam(column: np.ndarray, beam_size: int, log_threshold: float, active: np.ndarray) -> int:
+    """
+    Selects the states to keep at one position and sets the scores of all other states in column to -inf.
+    :param active: output buffer; its first (returned count) entries are set to the surviving tag indices, best first
+    :return: number of surviving states
+    """
+    # Repeated max scans pick the top states best-first without allocating; beams are small, so this is O(beam * num_tags)
+    num_tags = column.shape[0]
+    cutoff = -np.inf
+    num_active = 0
+    while num_active < beam_size:
+        best = -np.inf
+        best_y = -1
+        for y in range(num_tags):
+            if column[y] > best:
+                is_active = False
+                for k in range(num_active):
+                    if active[k] == y:
+                        is_active = True
+                        break
+                if not is_active:
+                    best = column[y]
+                    best_y = y
+        if num_active == 0:
+            if best_y == -1:
+                # Every state is -inf; keep one so decoding can continue
+                best_y = 0
+            cutoff = column[best_y] - log_threshold
+        elif best_y == -1 or best < cutoff:
+            break
+        active[num_active] = best_y
+        num_active += 1
+    for y in range(num_tags):
+        is_active = False
+        for k in range(num_active):
+            if active[k] == y:
+                is_active = True
+                break
+        if not is_active:
+            column[y] = -np.inf
+    return num_active
+
+
+@njit(cache=True, nogil=True)
+def _logsumexp(scores: np.ndarray) -> float:
+    max_score = -np.inf
+    for i in range(scores.shape[0]):
+        if scores[i] > max_score:
+            max_score = scores[i]
+    if max_score == -np.inf:
+        return max_score
+    total = 0.0
+    for i in range(scores.shape[0]):
+        total += np.exp(scores[i] - max_score)
+    return max_score + np.log(total)
+
+
+@njit(cache=True, nogil=True)
+def _forward_backward(feature_matrix: np.ndarray):
+    """
+    Compiled forward-backward for the emission-only CRF. With no transition features every tag at position x sees the
+    same log-sum over the previous column.
+    :param feature_matrix: [num_tags, num_words] emission scores
+    :return: ([num_tags, num_words] forward log scores, [num_tags, num_words] backward log scores, log partition Z)
+    """
+    num_tags, num_words = feature_matrix.shape
+    forward = np.empty((num_tags, num_words))
+    backward = np.empty((num_tags, num_words))
+    forward[:, 0] = feature_matrix[:, 0]
+    for x in range(1, num_words):
+        forward[:, x] = feature_matrix[:, x] + _logsumexp(forward[:, x - 1])
+    # The backward pass mirrors the forward one, walking from the last word to the first
+    backward[:, num_words - 1] = 0.0
+    for x in range(num_words - 2, -1, -1):
+        backward[:, x] = _logsumexp(backward[:, x + 1] + feature_matrix[:, x + 1])
+    return forward, backward, _logsumexp(forward[:, num_words - 1])
+
+
 def train_hmm_model(sentences: List[LabeledSentence]) -> HmmNerModel:
     """
     Uses maximum-likelihood estimation to read an HMM off of a corpus of sentences.
@@ -135,31 +320,28 @@ def train_hmm_model(sentences: List[LabeledSentence]) -> HmmNerModel:
     # matrices need to be.
     tag_indexer = Indexer()
     word_indexer = Indexer()
-    word_indexer.add_and_get_index("UNK")
-    word_counter = Counter()
-    for sentence in sentences:
-        for token in sentence.tokens:
-            word_counter[token.word] += 1.0
+    unk_idx = word_indexer.add_and_get_index("UNK")
+    word_counter = defaultdict(int)
     for sentence in sentences:
         for token in sentence.tokens:
-            # If the word occurs fewer than two times, don't index it -- we'll treat it as UNK
-            get_word_index(word_indexer, word_counter, token.word)
-        for tag in sentence.get_bio_tags():
-            tag_indexer.add_and_get_index(tag)
-
-    init_counts = np.ones((len(tag_indexer)), dtype=float) * 0.001
-    transition_counts = np.ones((len(tag_indexer), len(tag_indexer)), dtype=float) * 0.001
-    emission_counts = np.ones((len(tag_indexer), len(word_indexer)), dtype=float) * 0.001
+            word_counter[token.word] += 1
+    # If the word occurs fewer than two times, don't index it -- we'll treat it as UNK
+    rare_words = {word for word, count in word_counter.items() if count < 2}
+    # Word and gold tag indices of every sentence, kept so the counting pass doesn't redo the lookups
+    word_ids = []
+    gold_tags = []
     for sentence in sentences:
-        bio_tags = sentence.get_bio_tags()
-        for i in range(0, len(sentence)):
-            tag_idx = tag_indexer.add_and_get_index(bio_tags[i])
-            word_idx = get_word_index(word_indexer, word_counter, sentence.tokens[i].word)
-            emission_counts[tag_idx][word_idx] += 1.0
-            if i == 0:
-                init_counts[tag_idx] += 1.0
-            else:
-                transition_counts[tag_indexer.add_and_get_index(bio_tags[i-1])][tag_idx] += 1.0
+        word_ids.append(np.array([unk_idx if token.word in rare_words else word_indexer.add_and_get_index(token.word) for token in sentence.tokens], dtype=np.int32))
+        gold_tags.append(np.array([tag_indexer.add_and_get_index(tag) for tag in sentence.get_bio_tags()], dtype=np.int32))
+
+    # Log probabilities are kept in float32: decoding is bandwidth-bound and doesn't need double precision
+    init_counts = np.ones((len(tag_indexer)), dtype=np.float32) * 0.001
+    transition_counts = np.ones((len(tag_indexer), len(tag_indexer)), dtype=np.float32) * 0.001
+    emission_counts = np.ones((len(tag_indexer), len(word_indexer)), dtype=np.float32) * 0.001
+    # Scatter-add every count for the whole corpus at once. np.add.at (unlike fancy-index +=) accumulates repeated indices
+    np.add.at(init_counts, np.array([tag_ids[0] for tag_ids in gold_tags], dtype=np.int32), 1.0)
+    np.add.at(transition_counts, (np.concatenate([tag_ids[:-1] for tag_ids in gold_tags]), np.concatenate([tag_ids[1:] for tag_ids in gold_tags])), 1.0)
+    np.add.at(emission_counts, (np.concatenate(gold_tags), np.concatenate(word_ids)), 1.0)
     # Turn counts into probabilities for initial tags, transitions, and emissions. All
     # probabilities are stored as log probabilities
     print(repr(init_counts))
@@ -179,16 +361,17 @@ def train_hmm_model(sentences: List[LabeledSentence]) -> HmmNerModel:
     return HmmNerModel(tag_indexer, word_indexer, init_counts, transition_counts, emission_counts)
 
 
-def get_word_index(word_indexer: Indexer, word_counter: Counter, word: str) -> int:
+def get_word_index(word_indexer: Indexer, word_counter: Dict[str, int], word: str) -> int:
     """
     Retrieves a word's index based on its count. If the word occurs only once, treat it as an "UNK" token
     At test time, unknown words will be replaced by UNKs.
     :param word_indexer: Indexer mapping words to indices for HMM featurization
-    :param word_counter: Counter containing word counts of training set
+    :param word_counter: dict containing word counts of training set
     :param word: string word
     :return: int of the word index
     """
-    if word_counter[word] < 1.5:
+    # .get so that looking up an unseen word doesn't insert it into a defaultdict
+    if word_counter.get(word, 0) < 2:
         return word_indexer.add_and_get_index("UNK")
     else:
         return word_indexer.add_and_get_index(word)
@@ -199,152 +382,140 @@ class CrfNerModel(object):
         self.tag_indexer = tag_indexer
         self.feature_indexer = feature_indexer
         self.weights = weights
-
-    def decode(self, sentence_tokens: List[Token])->LabeledSentence:
-        pred_tags = []
-        N = len(sentence_tokens)
+        # BIO constraints are fixed for a tag set, so build them once: trans_mask[y_prev, y] is -inf for an illegal
+        # transition and 0 otherwise, and init_mask is -inf for tags that can't start a sentence
         T = len(self.tag_indexer)
-        v = np.zeros(shape=(T, N))
-        max_pred = np.zeros(shape=(T, N))
-        score_matrix = np.zeros(shape=(T, N))
-        for y in range(T):
-            for i in range(N):
-                features = extract_emission_features(sentence_tokens,i,self.tag_indexer.get_object(y),self.feature_indexer,add_to_indexer=False)
-                score = sum([self.weights[i] for i in features])
-                score_matrix[y, i] = score
-        # Initialization
+        self.trans_mask = np.zeros(shape=(T, T), dtype=np.float32)
+        self.init_mask = np.zeros(shape=T, dtype=np.float32)
         for y in range(T):
-            tag = str(self.tag_indexer.get_object(y))
-            if (isI(tag)):
-                v[y, 0] = float("-inf")
-            else:
-                v[y, 0] = score_matrix[y, 0]
-            max_pred[y, 0] = 0
-        # Recursion
-        for i in range(1, N):
-            for y in range(T):
-                prev_prob = np.zeros(T)
-                for y_prev in range(T):
-                    prev_tag = str(self.tag_indexer.get_object(y_prev))
-                    curr_tag = str(self.tag_indexer.get_object(y))
-                    if (isO(prev_tag) and isI(curr_tag)) or (isI(prev_tag) and isI(curr_tag) and get_tag_label(prev_tag) != get_tag_label(curr_tag)) or (isB(prev_tag) and isI(curr_tag) and get_tag_label(prev_tag) != get_tag_label(curr_tag)):
-                        prev_prob[y_prev] = float("-inf")
-                    else:
-                        prev_prob[y_prev] = v[y_prev, i - 1]
-                v[y, i] = np.max(prev_prob) + score_matrix[y, i]
-                max_pred[y, i] = np.argmax(prev_prob)
-        # Backtrace
-        pred_tags.append(self.tag_indexer.get_object(np.argmax(v[:, N - 1])))
-        for i in range(1, N):
-            pred_tags.append(self.tag_indexer.get_object(max_pred[self.tag_indexer.index_of(pred_tags[-1]), N - i]))
-        pred_tags = list(reversed(pred_tags))
-        return LabeledSentence(sentence_tokens, chunks_from_bio_tag_seq(pred_tags))
+            curr_tag = str(self.tag_indexer.get_object(y))
+            if isI(curr_tag):
+                self.init_mask[y] = float("-inf")
+            for y_prev in range(T):
+                prev_tag = str(self.tag_indexer.get_object(y_prev))
+                if (isO(prev_tag) and isI(curr_tag)) or (isI(prev_tag) and isI(curr_tag) and get_tag_label(prev_tag) != get_tag_label(curr_tag)) or (isB(prev_tag) and isI(curr_tag) and get_tag_label(prev_tag) != get_tag_label(curr_tag)):
+                    self.trans_mask[y_prev, y] = float("-inf")
 
+    def decode(self, sentence_tokens: List[Token], beam: int = None, threshold: float = None)->LabeledSentence:
+        """
+        :param sentence_tokens: List of the tokens in the sentence to tag
+        :param beam: if set, only the top beam states are kept at each position (approximate decoding)
+        :param threshold: if set, states scoring worse than the best by more than a factor of threshold are pruned
+        :return: The LabeledSentence consisting of predictions over the sentence
+        """
+        return self.decode_batch([sentence_tokens], beam, threshold)[0]
 
-# Trains a CrfNerModel on the given corpus of sentences.
-def train_crf_model(sentences, run_experiments=False):
+    def decode_batch(self, sentences_tokens: List[List[Token]], beam: int = None, threshold: float = None)->List[LabeledSentence]:
+        """
+        Decodes several sentences at once. Emission scores for the whole batch come from a single sparse matvec, which
+        amortizes the per-sentence overhead when tagging a full dev or test set.
+        :param sentences_tokens: list of token lists, one per sentence to tag
+        :param beam: see decode
+        :param threshold: see decode
+        :return: list of LabeledSentences, one per input sentence
+        """
+        T = len(self.tag_indexer)
+        # Extract every (sentence, word, tag) feature list once and score them all together
+        feature_lists = []
+        for sentence_tokens in sentences_tokens:
+            for i in range(len(sentence_tokens)):
+                feature_keys = _emission_feature_keys(sentence_tokens, i)
+                for y in range(T):
+                    feature_lists.append(extract_emission_features(sentence_tokens, i, self.tag_indexer.get_object(y), self.feature_indexer, add_to_indexer=False, feature_keys=feature_keys))
+        scores_all = (features_to_csr(feature_lists, len(self.weights)) @ self.weights).astype(np.float32).reshape(-1, T)
+        decoded = []
+        word_start = 0
+        for sentence_tokens in sentences_tokens:
+            N = len(sentence_tokens)
+            score_matrix = scores_all[word_start:word_start + N].T
+            word_start += N
+            v, max_pred = _decode_scratch.get(T, N, score_matrix.dtype)
+            # Illegal BIO transitions are masked out with -inf
+            if beam is None and threshold is None:
+                v, max_pred, best_last = _viterbi_decode(self.init_mask, self.trans_mask, score_matrix, v, max_pred)
+            else:
+                v, max_pred, best_last = _beam_decode(self.init_mask, self.trans_mask, score_matrix, v, max_pred, *_beam_args(T, beam, threshold))
+            # Backtrace
+            pred_tags = [self.tag_indexer.get_object(idx) for idx in _backtrace(max_pred, best_last)]
+            decoded.append(LabeledSentence(sentence_tokens, chunks_from_bio_tag_seq(pred_tags)))
+        return decoded
+
+
+# Trains a CrfNerModel on the given corpus of sentences. Each SGD step sums the gradients of batch_size sentences,
+# computed on up to n_jobs threads, or with PyTorch (on the GPU if there is one) when use_torch is set.
+def train_crf_model(sentences, run_experiments=False, batch_size=1, n_jobs=1, use_torch=False):
+    if use_torch and n_jobs != 1:
+        raise ValueError("n_jobs only applies to NumPy training; the PyTorch path batches sentences on one device instead")
     tag_indexer = Indexer()
     for sentence in sentences:
         for tag in sentence.get_bio_tags():
             tag_indexer.add_and_get_index(tag)
     print("Extracting features")
     feature_indexer = Indexer()
-    # 4-d list indexed by sentence index, word index, tag index, feature index
-    feature_cache = [[[[] for k in range(0, len(tag_indexer))] for j in range(0, len(sentences[i]))] for i in range(0, len(sentences))]
+    # Features are stored flat, CSR style: row k = (sentence, word, tag) in that order, and its features are
+    # feat_flat[offsets[k]:offsets[k + 1]]. This is far smaller than nested lists of Python ints.
+    sentence_flats = []
+    row_lengths = []
     for sentence_idx in range(0, len(sentences)):
         if sentence_idx % 100 == 0:
             print("Ex %i/%i" % (sentence_idx, len(sentences)))
+        row_feats = []
         for word_idx in range(0, len(sentences[sentence_idx])):
+            feature_keys = _emission_feature_keys(sentences[sentence_idx].tokens, word_idx)
             for tag_idx in range(0, len(tag_indexer)):
-                feature_cache[sentence_idx][word_idx][tag_idx] = extract_emission_features(sentences[sentence_idx].tokens, word_idx, tag_indexer.get_object(tag_idx), feature_indexer, add_to_indexer=True)
+                row_feats.append(extract_emission_features(sentences[sentence_idx].tokens, word_idx, tag_indexer.get_object(tag_idx), feature_indexer, add_to_indexer=True, feature_keys=feature_keys))
+        sentence_flats.append(np.concatenate(row_feats).astype(np.int32))
+        row_lengths.extend(len(feats) for feats in row_feats)
+    feat_flat = np.concatenate(sentence_flats)
+    del sentence_flats
+    offsets = np.zeros(len(row_lengths) + 1, dtype=np.int64)
+    np.cumsum(row_lengths, out=offsets[1:])
+    # One binary [num_words * num_tags, num_features] matrix per sentence (row word_idx * num_tags + tag_idx) so the
+    # feature scores for a whole sentence are a single sparse matvec. The matrices are views into feat_flat.
+    feat_data = np.ones(len(feat_flat), dtype=np.float32)
+    sentence_feature_mats = []
+    row_start = 0
+    for sentence_idx in range(0, len(sentences)):
+        row_end = row_start + len(sentences[sentence_idx]) * len(tag_indexer)
+        flat_start, flat_end = offsets[row_start], offsets[row_end]
+        sentence_feature_mats.append(sparse.csr_matrix((feat_data[flat_start:flat_end], feat_flat[flat_start:flat_end], offsets[row_start:row_end + 1] - flat_start), shape=(row_end - row_start, len(feature_indexer)), copy=False))
+        row_start = row_end
     print("Training")
 
+    # Gold tag indices don't change across epochs, so look them up once
+    gold_tags = [np.array([tag_indexer.index_of(tag) for tag in sentence.get_bio_tags()], dtype=np.int32) for sentence in sentences]
     sentence_num = int(len(sentences))
     weights = np.random.rand(len(feature_indexer))
-    optimizer = SGDOptimizer(weights, 0.1)
     epoch = 20
-    for i in tqdm(range(epoch)):
-        loss = 0
-        start = time.time()
-        train_index = np.arange(sentence_num)
-        np.random.shuffle(train_index)
-        for sentence_idx in train_index:
-            gradients = Counter()
-
-            N = len(sentences[sentence_idx])
-            T = len(tag_indexer)
-
-            #feature matrix
-            feature_matrix = np.zeros(shape=(T, N))
-            for y in range(T):
-                for x in range(N):
-                    feature_matrix[y, x] = np.sum(np.take(weights, feature_cache[sentence_idx][x][y]))
-
-            forward = np.zeros(shape=(T, N)) 
-            backward = np.zeros(shape=(T, N))
-            #   Forward-backward algorithm
-            # Initialization
-            for y in range(T):
-                forward[y, 0] = feature_matrix[y, 0]
-
-            # Recursion
-            for x in range(1, N):
-                for y in range(T):
-                    sum = 0
-                    for y_prev in range(T):
-                        if y_prev == 0:
-                            sum = forward[y_prev, x - 1]
-                        else:
-                            sum = np.logaddexp(sum, forward[y_prev, x - 1])
-                    forward[y, x] = feature_matrix[y, x] + sum
-
-            # Initialization 
-            for y in range(T):
-                backward[y, N - 1] = 0
-
-            # Recursion
-            for x in range(1, N):
-                for y in range(T):
-                    sum = 0
-                    for y_prev in range(T):
-                        if y_prev == 0:
-                            sum = backward[y_prev, N - x] + feature_matrix[y_prev, N - x]
-                        else:
-                            sum = np.logaddexp(sum, backward[y_prev, N - x] + feature_matrix[y_prev, N - x])
-                    backward[y, N - x - 1] = sum
-            Z = 0
-            for y in range(T):
-                if y == 0:
-                    Z = forward[y, -1]
+    if use_torch:
+        weights = _train_crf_torch(sentence_feature_mats, gold_tags, len(tag_indexer), weights, epoch, batch_size, 0.1)
+        return CrfNerModel(tag_indexer, feature_indexer, weights)
+    optimizer = SGDOptimizer(weights, 0.1)
+    # Sentences in a minibatch are independent given the current weights, so their gradients are computed in parallel
+    # (threads share weights and the feature matrices; the compiled kernels release the GIL) and summed into one update
+    with Parallel(n_jobs=n_jobs, prefer="threads") as parallel:
+        for i in tqdm(range(epoch)):
+            loss = 0
+            start = time.time()
+            train_index = np.arange(sentence_num)
+            np.random.shuffle(train_index)
+            for batch_start in range(0, sentence_num, batch_size):
+                batch = train_index[batch_start:batch_start + batch_size]
+                results = parallel(delayed(_compute_sentence_grad)(sentence_feature_mats[sentence_idx], gold_tags[sentence_idx], weights) for sentence_idx in batch)
+                if len(results) == 1:
+                    grad_indices, grad_values, sentence_loss = results[0]
+                    loss += sentence_loss
                 else:
-                    Z = np.logaddexp(Z, forward[y, -1])
-
-            # Compute the posterior probability
-            pp = np.zeros(shape=(T, N))
-            for y in range(T):
-                for x in range(N):
-                    pp[y, x] = np.exp(forward[y, x] + backward[y, x] - Z)
-
-            #  Compute the gradient of the feature vector for a sentence
-            for word_idx in range(len(sentences[sentence_idx])):
-                gold_tag = tag_indexer.index_of(sentences[sentence_idx].get_bio_tags()[word_idx])
-                features = feature_cache[sentence_idx][word_idx][gold_tag]
-                loss += np.sum([weights[i] for i in features])
-                for feature in features:
-                    gradients[feature] += 1
-                for tag_idx in range(T):
-                    features = feature_cache[sentence_idx][word_idx][tag_idx]
-                    for feature in features:
-                        gradients[feature] -= pp[tag_idx, word_idx]
-
-            # Update the weights using the gradient
-            loss -= Z
-            optimizer.apply_gradient_update(gradients, 10)
-
-        # Calculate the usage of time.
-        elapsed_time = time.time() - start
-        minutes, seconds = divmod(elapsed_time, 60)
-        print('epoch: {} time: {:0>2}:{} loss: {}'.format(i, int(minutes), int(seconds), -loss))
+                    grad_indices, inverse = np.unique(np.concatenate([result[0] for result in results]), return_inverse=True)
+                    grad_values = np.bincount(inverse, weights=np.concatenate([result[1] for result in results]), minlength=len(grad_indices))
+                    loss += sum(result[2] for result in results)
+                # Update the weights using the gradient
+                optimizer.apply_sparse_gradient_update(grad_indices, grad_values, len(batch))
+
+            # Calculate the usage of time.
+            elapsed_time = time.time() - start
+            minutes, seconds = divmod(elapsed_time, 60)
+            print('epoch: {} time: {:0>2}:{} loss: {}'.format(i, int(minutes), int(seconds), -loss))
     '''
     list of loss has been deleted.
     plt.plot(x,loss,label="Step=0.1")
@@ -366,7 +537,144 @@ def train_crf_model(sentences, run_experiments=False):
     return CrfNerModel(tag_indexer, feature_indexer, optimizer.get_final_weights())
 
 
-def extract_emission_features(sentence_tokens: List[Token], word_index: int, tag: str, feature_indexer: Indexer, add_to_indexer: bool):
+def _train_crf_torch(sentence_feature_mats: List[sparse.csr_matrix], gold_tags: List[np.ndarray], num_tags: int, weights: np.ndarray, epoch: int, batch_size: int, alpha: float) -> np.ndarray:
+    """
+    Runs the same minibatch SGD as train_crf_model with PyTorch, on the GPU when one is available. Each batch is padded
+    to its longest sentence and scored with one sparse matmul; forward runs over the whole batch at once and autograd
+    provides the gradient (gold features minus expected features).
+    :param sentence_feature_mats: per-sentence [num_words * num_tags, num_features] binary feature matrices
+    :param gold_tags: per-sentence int arrays of gold tag indices
+    :param num_tags: number of tags
+    :param weights: initial weight vector
+    :param epoch: number of passes over the data
+    :param batch_size: sentences per SGD step
+    :param alpha: step size, applied to the gradient averaged over the batch
+    :return: the trained weights as a numpy array
+    """
+    # Only this training path needs torch, so don't make it a dependency of the rest of the module
+    import torch
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    print("Training on %s" % device)
+    w = torch.tensor(weights, dtype=torch.float32, device=device, requires_grad=True)
+    lengths = np.array([len(tags) for tags in gold_tags])
+    sentence_num = len(gold_tags)
+    for i in tqdm(range(epoch)):
+        loss = 0
+        start = time.time()
+        train_index = np.arange(sentence_num)
+        np.random.shuffle(train_index)
+        # Bucket by length: sort each window of 50 batches so sentences that share a batch need little padding
+        window = batch_size * 50
+        for window_start in range(0, sentence_num, window):
+            chunk = train_index[window_start:window_start + window]
+            train_index[window_start:window_start + window] = chunk[np.argsort(lengths[chunk], kind="stable")]
+        for batch_start in range(0, sentence_num, batch_size):
+            batch = train_index[batch_start:batch_start + batch_size]
+            B = len(batch)
+            max_len = lengths[batch].max()
+            # Stack the batch's feature matrices into one [B * max_len * num_tags, num_features] COO tensor. The indices
+            # are in range by construction, so torch's invariant checks are skipped
+            rows = []
+            cols = []
+            gold = np.zeros((B, max_len), dtype=np.int64)
+            mask = np.zeros((B, max_len), dtype=bool)
+            for b, sentence_idx in enumerate(batch):
+                N = lengths[sentence_idx]
+                mat = sentence_feature_mats[sentence_idx]
+                rows.append(np.repeat(np.arange(N * num_tags) + b * max_len * num_tags, np.diff(mat.indptr)))
+                cols.append(mat.indices.astype(np.int64))
+                gold[b, :N] = gold_tags[sentence_idx]
+                mask[b, :N] = True
+            indices = torch.from_numpy(np.stack([np.concatenate(rows), np.concatenate(cols)]))
+            feats = torch.sparse_coo_tensor(indices, torch.ones(indices.shape[1]), (B * max_len * num_tags, len(weights)), device=device, check_invariants=False)
+            gold = torch.from_numpy(gold).to(device)
+            mask = torch.from_numpy(mask).to(device)
+            emission = torch.sparse.mm(feats, w.unsqueeze(1)).view(B, max_len, num_tags)
+
+            #   Forward algorithm. There are no transition features, so every tag at x sees the same log-sum over
+            #   the previous column; padded positions just carry the previous column through
+            forward = emission[:, 0, :]
+            for x in range(1, max_len):
+                step = emission[:, x, :] + torch.logsumexp(forward, dim=-1, keepdim=True)
+                forward = torch.where(mask[:, x:x + 1], step, forward)
+            Z = torch.logsumexp(forward, dim=-1)
+            gold_score = (emission.gather(2, gold.unsqueeze(-1)).squeeze(-1) * mask).sum(dim=1)
+            log_likelihood = (gold_score - Z).sum()
+
+            # Update the weights using the gradient, averaged over the batch like SGDOptimizer.apply_sparse_gradient_update
+            (-log_likelihood / B).backward()
+            with torch.no_grad():
+                w -= alpha * w.grad
+                w.grad.zero_()
+            loss += log_likelihood.item()
+
+        # Calculate the usage of time.
+        elapsed_time = time.time() - start
+        minutes, seconds = divmod(elapsed_time, 60)
+        print('epoch: {} time: {:0>2}:{} loss: {}'.format(i, int(minutes), int(seconds), -loss))
+    return w.detach().cpu().numpy().astype(np.float64)
+
+
+def _compute_sentence_grad(sentence_feats: sparse.csr_matrix, gold_tags: np.ndarray, weights: np.ndarray):
+    """
+    Computes the log-likelihood gradient for one sentence under the current weights. Only reads weights, so it is safe to
+    run for several sentences at once.
+    :param sentence_feats: [num_words * num_tags, num_features] binary feature matrix (row word_idx * num_tags + tag_idx)
+    :param gold_tags: [num_words] int array of gold tag indices
+    :param weights: current weight vector
+    :return: (unique feature indices, gradient value for each, log-likelihood of the gold sequence)
+    """
+    N = len(gold_tags)
+    T = sentence_feats.shape[0] // N
+
+    #feature matrix
+    feature_matrix = (sentence_feats @ weights).reshape(N, T).T
+
+    #   Forward-backward algorithm
+    forward, backward, Z = _forward_backward(feature_matrix)
+
+    # Compute the posterior probability
+    pp = np.exp(forward + backward - Z)
+
+    #  Compute the gradient of the feature vector for a sentence: +1 for every gold feature minus the
+    #  posterior of every (word, tag) feature, scattered into one compact sparse vector
+    gold_feats = sentence_feats[np.arange(N) * T + gold_tags].indices
+    loss = feature_matrix[gold_tags, np.arange(N)].sum() - Z
+    expected = np.repeat(pp.T.ravel(), np.diff(sentence_feats.indptr))
+    grad_indices, inverse = np.unique(np.concatenate([gold_feats, sentence_feats.indices]), return_inverse=True)
+    grad_values = np.bincount(inverse, weights=np.concatenate([np.ones(len(gold_feats)), -expected]), minlength=len(grad_indices))
+    return grad_indices, grad_values, loss
+
+
+def features_to_csr(feature_lists: List[np.ndarray], num_features: int) -> sparse.csr_matrix:
+    """
+    Stacks sparse feature vectors into a binary CSR matrix so they can all be scored against a weight vector at once.
+    :param feature_lists: list of int arrays of feature indices, one per row
+    :param num_features: total number of features (number of columns)
+    :return: [len(feature_lists), num_features] csr_matrix with a 1 for every feature occurrence
+    """
+    offsets = np.zeros(len(feature_lists) + 1, dtype=np.int64)
+    np.cumsum([len(feats) for feats in feature_lists], out=offsets[1:])
+    feat_flat = np.concatenate(feature_lists).astype(np.int32) if len(feature_lists) > 0 else np.zeros(0, dtype=np.int32)
+    return sparse.csr_matrix((np.ones(len(feat_flat)), feat_flat, offsets), shape=(len(feature_lists), num_features))
+
+
+# Maps every ASCII character to its word shape class: upper -> X, lower -> x, digit -> 0, anything else -> ?
+_WORD_SHAPE_TABLE = str.maketrans({chr(c): "X" if chr(c).isupper() else "x" if chr(c).islower() else "0" if chr(c).isdigit() else "?" for c in range(128)})
+
+
+def word_shape(word: str) -> str:
+    """
+    :param word: string word
+    :return: the word with uppercase letters replaced by X, lowercase by x, digits by 0 and everything else by ?
+    """
+    if word.isascii():
+        return word.translate(_WORD_SHAPE_TABLE)
+    # Non-ASCII words (e.g. umlauts in the German data) need the full unicode character classes
+    return "".join("X" if c.isupper() else "x" if c.islower() else "0" if c.isdigit() else "?" for c in word)
+
+
+def extract_emission_features(sentence_tokens: List[Token], word_index: int, tag: str, feature_indexer: Indexer, add_to_indexer: bool, feature_keys: List[str] = None):
     """
     Extracts emission features for tagging the word at word_index with tag.
     :param sentence_tokens: sentence to extract over
@@ -376,9 +684,27 @@ def extract_emission_features(sentence_tokens: List[Token], word_index: int, tag
     :param add_to_indexer: boolean variable indicating whether we should be expanding the indexer or not. This should
     be True at train time (since we want to learn weights for all features) and False at test time (to avoid creating
     any features we don't have weights for).
+    :param feature_keys: output of _emission_feature_keys for this word, if the caller already has it. Pass this when
+    featurizing the same word for every tag so the tag-independent strings are only built once.
     :return: an ndarray
     """
+    if feature_keys is None:
+        feature_keys = _emission_feature_keys(sentence_tokens, word_index)
     feats = []
+    for key in feature_keys:
+        maybe_add_feature(feats, feature_indexer, add_to_indexer, tag + ":" + key)
+    return np.asarray(feats, dtype=int)
+
+
+def _emission_feature_keys(sentence_tokens: List[Token], word_index: int) -> List[str]:
+    """
+    Builds the tag-independent part of every emission feature for the word at word_index; the actual features are these
+    strings prefixed with "<tag>:".
+    :param sentence_tokens: sentence to extract over
+    :param word_index: word index to consider
+    :return: list of feature strings without the tag
+    """
+    keys = []
     curr_word = sentence_tokens[word_index].word
     # Lexical and POS features on this word, the previous, and the next (Word-1, Word0, Word1)
     for idx_offset in range(-1, 2):
@@ -394,27 +720,17 @@ def extract_emission_features(sentence_tokens: List[Token], word_index: int, tag
             active_pos = "</S>"
         else:
             active_pos = sentence_tokens[word_index + idx_offset].pos
-        maybe_add_feature(feats, feature_indexer, add_to_indexer, tag + ":Word" + repr(idx_offset) + "=" + active_word)
-        maybe_add_feature(feats, feature_indexer, add_to_indexer, tag + ":Pos" + repr(idx_offset) + "=" + active_pos)
+        keys.append("Word" + repr(idx_offset) + "=" + active_word)
+        keys.append("Pos" + repr(idx_offset) + "=" + active_pos)
     # Character n-grams of the current word
     max_ngram_size = 3
     for ngram_size in range(1, max_ngram_size+1):
         start_ngram = curr_word[0:min(ngram_size, len(curr_word))]
-        maybe_add_feature(feats, feature_indexer, add_to_indexer, tag + ":StartNgram=" + start_ngram)
+        keys.append("StartNgram=" + start_ngram)
         end_ngram = curr_word[max(0, len(curr_word) - ngram_size):]
-        maybe_add_feature(feats, feature_indexer, add_to_indexer, tag + ":EndNgram=" + end_ngram)
+        keys.append("EndNgram=" + end_ngram)
     # Look at a few word shape features
-    maybe_add_feature(feats, feature_indexer, add_to_indexer, tag + ":IsCap=" + repr(curr_word[0].isupper()))
+    keys.append("IsCap=" + repr(curr_word[0].isupper()))
     # Compute word shape
-    new_word = []
-    for i in range(0, len(curr_word)):
-        if curr_word[i].isupper():
-            new_word += "X"
-        elif curr_word[i].islower():
-            new_word += "x"
-        elif curr_word[i].isdigit():
-            new_word += "0"
-        else:
-            new_word += "?"
-    maybe_add_feature(feats, feature_indexer, add_to_indexer, tag + ":WordShape=" + repr(new_word))
-    return np.asarray(feats, dtype=int)
\ No newline at end of file
+    keys.append("WordShape=" + repr(list(word_shape(curr_word))))
+    return keys
@@ -22,6 +22,9 @@ def _parse_args():
     parser.add_argument('--dev_path', type=str, default='data/eng.testa', help='path to dev set (you should not need to modify)')
     parser.add_argument('--blind_test_path', type=str, default='data/eng.testb.blind', help='path to blind test set (you should not need to modify)')
     parser.add_argument('--test_output_path', type=str, default='eng.testb.out', help='output path for test predictions')
+    parser.add_argument('--batch_size', type=int, default=1, help='number of sentences per CRF SGD update (the gradient is averaged over the batch)')
+    parser.add_argument('--n_jobs', type=int, default=1, help='threads used to compute CRF gradients within a batch (-1 for all cores); not supported with --torch')
+    parser.add_argument('--torch', dest='use_torch', default=False, action='store_true', help='train the CRF with PyTorch (uses the GPU if available)')
     parser.add_argument('--no_run_on_test', dest='run_on_test', default=True, action='store_false', help='skip printing output on the test set')
     args = parser.parse_args()
     return args
@@ -91,13 +94,13 @@ if __name__ == '__main__':
         hmm_model = train_hmm_model(train)
         dev_decoded = [hmm_model.decode(test_ex.tokens) for test_ex in dev]
     elif system_to_run == "CRF":
-        crf_model = train_crf_model(train)
+        crf_model = train_crf_model(train, batch_size=args.batch_size, n_jobs=args.n_jobs, use_torch=args.use_torch)
         print("Data reading and training took %f seconds" % (time.time() - start_time))
-        dev_decoded = [crf_model.decode(test_ex.tokens) for test_ex in dev]
+        dev_decoded = crf_model.decode_batch([test_ex.tokens for test_ex in dev])
         if args.run_on_test:
             print("Running on test")
             test = read_data(args.blind_test_path)
-            test_decoded = [crf_model.decode(test_ex.tokens) for test_ex in test]
+            test_decoded = crf_model.decode_batch([test_ex.tokens for test_ex in test])
             print_output(test_decoded, args.test_output_path)
     else:
         raise Exception("Pass in either BAD, HMM, or CRF to run the appropriate system")
@@ -27,6 +27,15 @@ class Optimizer(ABC):
     def apply_gradient_update(self, gradient: Counter, batch_size: int):
         pass
 
+    def apply_sparse_gradient_update(self, indices: np.ndarray, values: np.ndarray, batch_size: int):
+        """
+        Same as apply_gradient_update, but with the sparse gradient given as parallel arrays instead of a Counter
+        :param indices: int array of unique feature indices
+        :param values: gradient value for each index
+        :param batch_size: how many examples the gradient was computed on
+        """
+        self.apply_gradient_update(Counter(dict(zip(indices.tolist(), values.tolist()))), batch_size)
+
     @abstractmethod
     def access(self, i: int):
         pass
@@ -61,6 +70,17 @@ class SGDOptimizer(Optimizer):
         for i in gradient.keys():
             self.weights[i] = self.weights[i] + self.alpha * gradient[i]
 
+    def apply_sparse_gradient_update(self, indices: np.ndarray, values: np.ndarray, batch_size: int):
+        """
+        Vectorized update for a gradient given as parallel index/value arrays. The gradient is divided by the batch size
+        so that alpha is the step size per example whatever the batch size is
+        :param indices: int array of unique feature indices
+        :param values: gradient value for each index, summed over the batch
+        :param batch_size: how many examples the gradient was computed on
+        :return: nothing, modifies weights in-place
+        """
+        self.weights[indices] += (self.alpha / batch_size) * values
+
     def access(self, i: int):
         """
         :param i: index of the weight to access